@@ -1,139 +1,420 @@
 from __future__ import annotations
 
+import asyncio
+import base64
+import functools
+import hashlib
+import logging
 import os
+import re
+import threading
 import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from datetime import datetime, timezone
-from typing import Any, Dict, Iterable, Optional
+from typing import Any, Dict, Iterable, List, Optional, Protocol, Sequence, Tuple
 
+import certifi
 import httpx
 import jwt
+import orjson
 from dotenv import load_dotenv
+from fastapi.responses import ORJSONResponse
 from jwt import algorithms
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
-from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 load_dotenv()
 
+logger = logging.getLogger("notion.auth")
+
 SUPABASE_PROJECT_URL = os.getenv("SUPABASE_PROJECT_URL", "https://your-project.supabase.co")
 SUPABASE_JWT_AUDIENCE = os.getenv("SUPABASE_JWT_AUDIENCE", "authenticated")
 SUPABASE_ISSUER = os.getenv("SUPABASE_ISSUER_URL") or f"{SUPABASE_PROJECT_URL}/auth/v1"
 SUPABASE_JWKS_URL = os.getenv("SUPABASE_JWKS_URL") or f"{SUPABASE_ISSUER}/.well-known/jwks.json"
+# Comma-separated Redis URLs, one per principal shard; unset keeps principals in memory.
+PRINCIPAL_REDIS_URLS = [url for url in os.getenv("PRINCIPAL_REDIS_URLS", "").split(",") if url]
 
 DEFAULT_JWKS_TTL_SECONDS = 3600
+DEFAULT_JWKS_MIN_REFRESH_SECONDS = 60
+JWKS_PREFETCH_RATIO = 0.9
+DEFAULT_JWT_CACHE_SIZE = 4096
+DEFAULT_JWT_LEEWAY_SECONDS = 0
+PRINCIPAL_STORE_SHARDS = 32  # must be a power of two
+
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+# Opt-in: verify cache misses in a thread pool. Only the OpenSSL RSA check
+# releases the GIL, so the executor hop costs more than it saves unless several
+# cores are free and many distinct tokens arrive concurrently.
+JWT_VERIFY_IN_THREAD = os.getenv("JWT_VERIFY_IN_THREAD", "").lower() in ("1", "true", "yes")
+_VERIFY_POOL = (
+    ThreadPoolExecutor(max_workers=max(2, os.cpu_count() or 1), thread_name_prefix="jwt-verify")
+    if JWT_VERIFY_IN_THREAD
+    else None
+)
 
+_JWKS_HTTP = httpx.AsyncClient(
+    timeout=10,
+    verify=certifi.where(),
+    limits=httpx.Limits(max_keepalive_connections=8),
+)
 
-def _utcnow() -> datetime:
-    return datetime.now(timezone.utc)
 
+async def close_jwks_http() -> None:
+    await _JWKS_HTTP.aclose()
 
-@dataclass
+
+@dataclass(slots=True, frozen=True)
 class PrincipalRecord:
     iss: str
     sub: str
-    created_at: datetime
+    created_at: float  # epoch seconds
+
+
+class PrincipalStore(Protocol):
+    async def get_or_create(self, iss: str, sub: str) -> PrincipalRecord: ...
+
+    async def aclose(self) -> None: ...
 
 
 class InMemoryPrincipalStore:
     """In-memory principal store placeholder before DB persistence is added."""
 
     def __init__(self) -> None:
-        self._records: Dict[str, PrincipalRecord] = {}
+        self._shards: List[Tuple[threading.Lock, Dict[str, PrincipalRecord]]] = [
+            (threading.Lock(), {}) for _ in range(PRINCIPAL_STORE_SHARDS)
+        ]
+
+    def _shard(self, key: str) -> Tuple[threading.Lock, Dict[str, PrincipalRecord]]:
+        return self._shards[hash(key) & (PRINCIPAL_STORE_SHARDS - 1)]
 
-    def get_or_create(self, iss: str, sub: str) -> PrincipalRecord:
+    async def get_or_create(self, iss: str, sub: str) -> PrincipalRecord:
         key = f"{iss}|{sub}"
-        record = self._records.get(key)
-        if record is None:
-            record = PrincipalRecord(iss=iss, sub=sub, created_at=_utcnow())
-            self._records[key] = record
-        return record
+        lock, records = self._shard(key)
+        record = records.get(key)
+        if record is not None:
+            return record
+        with lock:
+            record = records.get(key)
+            if record is None:
+                record = PrincipalRecord(iss=iss, sub=sub, created_at=time.time())
+                records[key] = record
+            return record
+
+    async def aclose(self) -> None:
+        pass
+
+
+class RedisShardedPrincipalStore:
+    """Principal store persisted across Redis instances, sharded by `sub`.
+
+    Each shard keeps one hash, ``principals:{n}``, mapping ``iss|sub`` to the
+    JSON record. The shard is picked by a CRC32 of `sub`, which is stable across
+    restarts, so writes for unrelated users land on independent instances.
+    """
+
+    def __init__(self, urls: Sequence[str]) -> None:
+        if not urls:
+            raise ValueError("At least one Redis URL is required.")
+        try:
+            from redis import asyncio as redis
+        except ImportError as exc:
+            raise RuntimeError("RedisShardedPrincipalStore requires the 'redis' extra.") from exc
+        self._shards = [redis.Redis.from_url(url) for url in urls]
+
+    async def get_or_create(self, iss: str, sub: str) -> PrincipalRecord:
+        index = zlib.crc32(sub.encode()) % len(self._shards)
+        key = f"principals:{{{index}}}"
+        field = f"{iss}|{sub}"
+        candidate = orjson.dumps({"iss": iss, "sub": sub, "created_at": time.time()})
+        # HSETNX + HGET in one round trip: the first writer wins, everyone reads it back.
+        async with self._shards[index].pipeline(transaction=False) as pipe:
+            pipe.hsetnx(key, field, candidate)
+            pipe.hget(key, field)
+            _, stored = await pipe.execute()
+        data = orjson.loads(stored)
+        return PrincipalRecord(iss=data["iss"], sub=data["sub"], created_at=data["created_at"])
+
+    async def aclose(self) -> None:
+        for client in self._shards:
+            await client.aclose()
 
 
 class SupabaseJwksClient:
-    def __init__(self, jwks_url: str = SUPABASE_JWKS_URL, ttl_seconds: int = DEFAULT_JWKS_TTL_SECONDS) -> None:
+    def __init__(
+        self,
+        jwks_url: str = SUPABASE_JWKS_URL,
+        ttl_seconds: int = DEFAULT_JWKS_TTL_SECONDS,
+        min_refresh_seconds: int = DEFAULT_JWKS_MIN_REFRESH_SECONDS,
+    ) -> None:
         self._jwks_url = jwks_url
         self._ttl_seconds = ttl_seconds
+        self._min_refresh_seconds = min_refresh_seconds
         self._jwks: Optional[Dict[str, Any]] = None
-        self._fetched_at: Optional[float] = None
+        self._keys_by_kid: Dict[str, Any] = {}
+        self._attempted_at: float = 0.0
+        self._etag: Optional[str] = None
+        self._last_modified: Optional[str] = None
+        self._next_refresh: float = 0.0
+        self._refresh_task: Optional[asyncio.Task[Dict[str, Any] | None]] = None
 
-    def get_jwks(self) -> Dict[str, Any] | None:
-        now = time.time()
-        if self._jwks and self._fetched_at and (now - self._fetched_at) < self._ttl_seconds:
-            return self._jwks
-        with httpx.Client(timeout=10) as client:
-            response = client.get(self._jwks_url)
+    def _refresh_interval(self, response: httpx.Response) -> int:
+        match = _MAX_AGE_RE.search(response.headers.get("cache-control", ""))
+        max_age = int(match.group(1)) if match else self._ttl_seconds
+        return max(max_age, self._min_refresh_seconds)
+
+    async def refresh(self) -> Dict[str, Any] | None:
+        """Revalidate the JWKS, sending If-None-Match/If-Modified-Since when possible."""
+        self._attempted_at = time.time()
+        headers: Dict[str, str] = {}
+        if self._jwks is not None:
+            if self._etag:
+                headers["If-None-Match"] = self._etag
+            if self._last_modified:
+                headers["If-Modified-Since"] = self._last_modified
+        response = await _JWKS_HTTP.get(self._jwks_url, headers=headers)
+        if response.status_code != 304:
             response.raise_for_status()
-            self._jwks = response.json()
-            self._fetched_at = now
+            jwks = orjson.loads(response.content)
+            self._keys_by_kid = {
+                key["kid"]: algorithms.RSAAlgorithm.from_jwk(key)
+                for key in jwks.get("keys", [])
+                if key.get("kty") == "RSA" and "kid" in key
+            }
+            self._jwks = jwks
+            self._etag = response.headers.get("etag")
+            self._last_modified = response.headers.get("last-modified")
+        self._next_refresh = time.time() + self._refresh_interval(response)
+        return self._jwks
+
+    async def _refresh_once(self) -> Dict[str, Any] | None:
+        # Single-flight: concurrent callers share one in-flight fetch and its outcome.
+        task = self._refresh_task
+        if task is None:
+            task = self._refresh_task = asyncio.create_task(self.refresh())
+            task.add_done_callback(self._clear_refresh_task)
+        return await asyncio.shield(task)
+
+    def _clear_refresh_task(self, task: asyncio.Task[Dict[str, Any] | None]) -> None:
+        if self._refresh_task is task:
+            self._refresh_task = None
+
+    async def get_jwks(self) -> Dict[str, Any] | None:
+        # Requests only read the cached keys; start_refresher keeps them current
+        # and retries failures, so a JWKS outage leaves the last good set in use.
+        # Fetch inline only before the first successful load.
+        if self._jwks is not None:
             return self._jwks
+        return await self._refresh_once()
+
+    async def start_refresher(self) -> None:
+        """Keep the JWKS warm by refreshing it shortly before it goes stale."""
+        while True:
+            try:
+                await self._refresh_once()
+            except Exception:
+                logger.warning("JWKS refresh failed; retrying.", exc_info=True)
+                await asyncio.sleep(self._min_refresh_seconds)
+                continue
+            await asyncio.sleep(max(self._next_refresh - time.time(), 0) * JWKS_PREFETCH_RATIO)
 
-    def get_key(self, kid: str) -> Any:
-        jwks = self.get_jwks()
-        if not jwks:
+    async def get_key(self, kid: str) -> Any:
+        if not await self.get_jwks():
             raise ValueError("No JWKS available.")
-        for key in jwks.get("keys", []):
-            if key.get("kid") == kid:
-                return algorithms.RSAAlgorithm.from_jwk(key)
-        raise ValueError("No matching JWKS key found.")
+        key = self._keys_by_kid.get(kid)
+        if key is None and time.time() - self._attempted_at >= self._min_refresh_seconds:
+            # Unknown kid usually means the keys were rotated; refetch once.
+            try:
+                await self._refresh_once()
+            except Exception:
+                logger.warning("JWKS refresh for unknown kid failed.", exc_info=True)
+            key = self._keys_by_kid.get(kid)
+        if key is None:
+            raise ValueError("No matching JWKS key found.")
+        return key
+
+
+def _claim_bounds(payload: Dict[str, Any]) -> Tuple[Optional[float], Optional[float]]:
+    # PyJWT accepts anything int() takes (e.g. numeric strings), so normalize once
+    # after it validated the token instead of comparing raw claims on each hit.
+    exp = payload.get("exp")
+    nbf = payload.get("nbf")
+    return (None if exp is None else float(exp)), (None if nbf is None else float(nbf))
+
+
+def _claims_current(exp: Optional[float], nbf: Optional[float]) -> bool:
+    now = time.time()
+    if exp is not None and exp <= now - DEFAULT_JWT_LEEWAY_SECONDS:
+        return False
+    return nbf is None or nbf <= now + DEFAULT_JWT_LEEWAY_SECONDS
+
+
+class VerifiedJwtCache:
+    """LRU of verified JWT payloads; exp/nbf are re-checked on every hit.
+
+    Payloads are stored serialized and decoded per hit, so each caller gets its
+    own dict and mutating it cannot alter the cached claims. Entries can also
+    carry the principal resolved for the token, so a repeat request skips the
+    principal store as well.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_JWT_CACHE_SIZE) -> None:
+        self._maxsize = maxsize
+        self._entries: OrderedDict[
+            tuple[bytes, str, str],
+            Tuple[bytes, Optional[float], Optional[float], Optional[PrincipalRecord]],
+        ] = OrderedDict()
+
+    @staticmethod
+    def key_for(token: str, audience: str, issuer: str) -> tuple[bytes, str, str]:
+        return hashlib.blake2b(token.encode(), digest_size=16).digest(), audience, issuer
 
+    def get(
+        self, key: tuple[bytes, str, str]
+    ) -> Optional[Tuple[Dict[str, Any], Optional[PrincipalRecord]]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        encoded, exp, nbf, principal = entry
+        if not _claims_current(exp, nbf):
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return orjson.loads(encoded), principal
 
-def verify_jwt(
+    def put(
+        self,
+        key: tuple[bytes, str, str],
+        payload: Dict[str, Any],
+        principal: Optional[PrincipalRecord] = None,
+    ) -> None:
+        try:
+            encoded = orjson.dumps(payload)
+            exp, nbf = _claim_bounds(payload)
+        except (orjson.JSONEncodeError, TypeError, ValueError, OverflowError):
+            return  # e.g. integers beyond 64 bits; just verify those tokens every time
+        self._entries[key] = (encoded, exp, nbf, principal)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+
+
+VERIFIED_JWT_CACHE = VerifiedJwtCache()
+
+
+def _unverified_header(token: str) -> Dict[str, Any]:
+    # Only the header segment is needed to pick a key; jwt.get_unverified_header
+    # would also base64-decode the payload and signature that jwt.decode redoes.
+    header_b64 = token.partition(".")[0]
+    try:
+        header = orjson.loads(base64.urlsafe_b64decode(header_b64 + "=" * (-len(header_b64) % 4)))
+    except ValueError as exc:
+        raise ValueError("Invalid JWT header.") from exc
+    if not isinstance(header, dict):
+        raise ValueError("Invalid JWT header.")
+    return header
+
+
+async def verify_jwt(
     token: str,
     jwks_client: SupabaseJwksClient,
     audience: str = SUPABASE_JWT_AUDIENCE,
     issuer: str = SUPABASE_ISSUER,
+    cache: Optional[VerifiedJwtCache] = VERIFIED_JWT_CACHE,
 ) -> Dict[str, Any]:
-    headers = jwt.get_unverified_header(token)
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.key_for(token, audience, issuer)
+        hit = cache.get(cache_key)
+        if hit is not None:
+            return hit[0]
+
+    headers = _unverified_header(token)
     kid = headers.get("kid")
-    if not kid:
+    if not isinstance(kid, str) or not kid:
         raise ValueError("JWT missing kid header.")
-    key = jwks_client.get_key(kid)
-    return jwt.decode(
+    key = await jwks_client.get_key(kid)
+    decode = functools.partial(
+        jwt.decode,
         token,
         key=key,
         algorithms=["RS256"],
         audience=audience,
         issuer=issuer,
+        leeway=DEFAULT_JWT_LEEWAY_SECONDS,
     )
+    if _VERIFY_POOL is None:
+        payload = decode()
+    else:
+        payload = await asyncio.get_running_loop().run_in_executor(_VERIFY_POOL, decode)
+    if cache is not None:
+        cache.put(cache_key, payload)
+    return payload
 
 
-def _is_public_path(path: str, public_paths: Iterable[str]) -> bool:
-    return any(path.startswith(public_path) for public_path in public_paths)
+def _get_header(scope: Scope, name: bytes) -> bytes:
+    for key, value in scope["headers"]:
+        if key == name:
+            return value
+    return b""
 
 
-class JWTAuthMiddleware(BaseHTTPMiddleware):
+class JWTAuthMiddleware:
     def __init__(
         self,
-        app,
+        app: ASGIApp,
         jwks_client: SupabaseJwksClient,
-        principal_store: InMemoryPrincipalStore,
+        principal_store: PrincipalStore,
         public_paths: Iterable[str],
+        cache: VerifiedJwtCache = VERIFIED_JWT_CACHE,
     ) -> None:
-        super().__init__(app)
+        self.app = app
         self._jwks_client = jwks_client
         self._principal_store = principal_store
-        self._public_paths = list(public_paths)
+        # A tuple lets str.startswith do the prefix scan in C.
+        self._public_paths = tuple(public_paths)
+        self._cache = cache
 
-    async def dispatch(self, request: Request, call_next):
-        if _is_public_path(request.url.path, self._public_paths):
-            return await call_next(request)
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        # scope["path"] is already a decoded str, so public routes such as
+        # health probes pass through without any allocation.
+        if scope["type"] != "http" or scope["path"].startswith(self._public_paths):
+            await self.app(scope, receive, send)
+            return
 
-        auth_header = request.headers.get("authorization", "")
-        if not auth_header.startswith("Bearer "):
-            return JSONResponse({"error": "Missing Bearer token."}, status_code=401)
+        auth_header = _get_header(scope, b"authorization")
+        if not auth_header.startswith(b"Bearer "):
+            response = ORJSONResponse({"error": "Missing Bearer token."}, status_code=401)
+            await response(scope, receive, send)
+            return
 
-        token = auth_header.split(" ", 1)[1]
+        token = auth_header[7:].decode("latin-1")
+        principal = None
         try:
-            payload = verify_jwt(token, self._jwks_client)
+            cache_key = self._cache.key_for(token, SUPABASE_JWT_AUDIENCE, SUPABASE_ISSUER)
+            hit = self._cache.get(cache_key)
+            if hit is not None:
+                payload, principal = hit
+            else:
+                payload = await verify_jwt(token, self._jwks_client, cache=None)
         except Exception as exc:
-            return JSONResponse({"error": f"Invalid token: {exc}"}, status_code=401)
+            response = ORJSONResponse({"error": f"Invalid token: {exc}"}, status_code=401)
+            await response(scope, receive, send)
+            return
+
+        if principal is None:
+            iss = payload.get("iss", "")
+            sub = payload.get("sub", "")
+            if not iss or not sub:
+                response = ORJSONResponse({"error": "Token missing iss/sub."}, status_code=401)
+                await response(scope, receive, send)
+                return
 
-        iss = payload.get("iss", "")
-        sub = payload.get("sub", "")
-        if not iss or not sub:
-            return JSONResponse({"error": "Token missing iss/sub."}, status_code=401)
+            principal = await self._principal_store.get_or_create(iss=iss, sub=sub)
+            self._cache.put(cache_key, payload, principal)
 
-        request.state.principal = self._principal_store.get_or_create(iss=iss, sub=sub)
-        request.state.jwt_payload = payload
-        return await call_next(request)
+        state = scope.setdefault("state", {})
+        state["principal"] = principal
+        state["jwt_payload"] = payload
+        await self.app(scope, receive, send)
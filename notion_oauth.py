@@ -1,13 +1,16 @@
 import base64
+import heapq
 import os
 import secrets
+import threading
+import time
 import urllib.parse
 from dataclasses import dataclass
-from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import certifi
 import httpx
+import orjson
 from dotenv import load_dotenv
 
 NOTION_API_URL = "https://api.notion.com"
@@ -26,10 +29,23 @@ NOTION_REDIRECT_URI = os.getenv(
 )
 NOTION_OAUTH_OWNER = os.getenv("NOTION_OAUTH_OWNER", "user")
 DEFAULT_STATE_TTL_SECONDS = 600
+STATE_STORE_SHARDS = 32  # must be a power of two
+
+_NOTION_STATIC_HEADERS = {
+    "Notion-Version": NOTION_VERSION,
+    "Content-Type": "application/json",
+    "User-Agent": USER_AGENT,
+}
+
+_NOTION_HTTP = httpx.AsyncClient(
+    timeout=20,
+    verify=certifi.where(),
+    limits=httpx.Limits(max_keepalive_connections=8),
+)
 
 
-def _utcnow() -> datetime:
-    return datetime.now(timezone.utc)
+async def close_notion_http() -> None:
+    await _NOTION_HTTP.aclose()
 
 
 def _basic_auth_header(client_id: str, client_secret: str) -> str:
@@ -38,20 +54,37 @@ def _basic_auth_header(client_id: str, client_secret: str) -> str:
     return f"Basic {token}"
 
 
-@dataclass
+_STATIC_BASIC_AUTH = _basic_auth_header(NOTION_CLIENT_ID, NOTION_CLIENT_SECRET)
+
+
+@dataclass(slots=True)
 class OAuthState:
     state: str
-    created_at: datetime
-    expires_at: datetime
-    consumed_at: Optional[datetime] = None
+    # Timestamps are epoch seconds; convert to datetime only when serializing.
+    created_at: float
+    expires_at: float
+    consumed_at: Optional[float] = None
     principal_id: Optional[str] = None
 
 
+# (lock, states by key, min-heap of (expires_at, state) for reaping)
+_StateShard = Tuple[threading.Lock, Dict[str, OAuthState], List[Tuple[float, str]]]
+
+
+def _reap_expired(states: Dict[str, OAuthState], expiry_heap: List[Tuple[float, str]], now: float) -> None:
+    while expiry_heap and expiry_heap[0][0] <= now:
+        _, state = heapq.heappop(expiry_heap)
+        states.pop(state, None)
+
+
 class InMemoryStateStore:
     """In-memory OAuth state store. Mirrors schema.sql oauth_states table."""
 
     def __init__(self) -> None:
-        self._states: Dict[str, OAuthState] = {}
+        self._shards: List[_StateShard] = [(threading.Lock(), {}, []) for _ in range(STATE_STORE_SHARDS)]
+
+    def _shard(self, state: str) -> _StateShard:
+        return self._shards[hash(state) & (STATE_STORE_SHARDS - 1)]
 
     def create(
         self,
@@ -59,8 +92,8 @@ class InMemoryStateStore:
         principal_id: Optional[str] = None,
     ) -> OAuthState:
         state = secrets.token_urlsafe(32)
-        now = _utcnow()
-        expires_at = now + timedelta(seconds=ttl_seconds)
+        now = time.time()
+        expires_at = now + ttl_seconds
         record = OAuthState(
             state=state,
             created_at=now,
@@ -68,28 +101,35 @@ class InMemoryStateStore:
             consumed_at=None,
             principal_id=principal_id,
         )
-        self._states[state] = record
+        lock, states, expiry_heap = self._shard(state)
+        with lock:
+            _reap_expired(states, expiry_heap, now)
+            states[state] = record
+            heapq.heappush(expiry_heap, (expires_at, state))
         return record
 
     def consume(self, state: str) -> Optional[OAuthState]:
-        record = self._states.get(state)
-        if record is None:
-            return None
-        now = _utcnow()
-        if record.consumed_at is not None:
-            return None
-        if record.expires_at <= now:
-            return None
-        record.consumed_at = now
-        return record
-
-
-@dataclass
+        lock, states, expiry_heap = self._shard(state)
+        now = time.time()
+        with lock:
+            _reap_expired(states, expiry_heap, now)
+            record = states.get(state)
+            if record is None:
+                return None
+            if record.consumed_at is not None:
+                return None
+            if record.expires_at <= now:
+                return None
+            record.consumed_at = now
+            return record
+
+
+@dataclass(slots=True)
 class TokenRecord:
     access_token: str
     workspace_id: Optional[str]
     workspace_name: Optional[str]
-    created_at: datetime
+    created_at: float
     scope: Optional[str]
     raw: Dict[str, Any]
 
@@ -144,26 +184,28 @@ def start_oauth(
     return {"redirect_url": redirect_url, "state": record.state}
 
 
-def exchange_token(
+async def exchange_token(
     code: str,
     client_id: str = NOTION_CLIENT_ID,
     client_secret: str = NOTION_CLIENT_SECRET,
     redirect_uri: str = NOTION_REDIRECT_URI,
 ) -> Dict[str, Any]:
     headers = {
-        "Authorization": _basic_auth_header(client_id, client_secret),
-        "Content-Type": "application/json",
-        "User-Agent": USER_AGENT,
+        **_NOTION_STATIC_HEADERS,
+        "Authorization": (
+            _STATIC_BASIC_AUTH
+            if client_id == NOTION_CLIENT_ID and client_secret == NOTION_CLIENT_SECRET
+            else _basic_auth_header(client_id, client_secret)
+        ),
     }
     payload = {
         "grant_type": "authorization_code",
         "code": code,
         "redirect_uri": redirect_uri,
     }
-    with httpx.Client(timeout=20, verify=certifi.where()) as client:
-        response = client.post(NOTION_OAUTH_TOKEN_URL, json=payload, headers=headers)
-        response.raise_for_status()
-        return response.json()
+    response = await _NOTION_HTTP.post(NOTION_OAUTH_TOKEN_URL, content=orjson.dumps(payload), headers=headers)
+    response.raise_for_status()
+    return orjson.loads(response.content)
 
 
 def store_token(
@@ -174,7 +216,7 @@ def store_token(
         access_token=token_response.get("access_token", ""),
         workspace_id=token_response.get("workspace_id"),
         workspace_name=token_response.get("workspace_name"),
-        created_at=_utcnow(),
+        created_at=time.time(),
         scope=token_response.get("scope"),
         raw=token_response,
     )
@@ -182,21 +224,15 @@ def store_token(
     return record
 
 
-def smoke_test_search(access_token: str) -> Dict[str, Any]:
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Notion-Version": NOTION_VERSION,
-        "Content-Type": "application/json",
-        "User-Agent": USER_AGENT,
-    }
+async def smoke_test_search(access_token: str) -> Dict[str, Any]:
+    headers = {**_NOTION_STATIC_HEADERS, "Authorization": f"Bearer {access_token}"}
     payload = {"query": "", "page_size": 1}
-    with httpx.Client(timeout=20, verify=certifi.where()) as client:
-        response = client.post(f"{NOTION_API_URL}/v1/search", json=payload, headers=headers)
-        response.raise_for_status()
-        return response.json()
+    response = await _NOTION_HTTP.post(f"{NOTION_API_URL}/v1/search", content=orjson.dumps(payload), headers=headers)
+    response.raise_for_status()
+    return orjson.loads(response.content)
 
 
-def handle_callback(
+async def handle_callback(
     code: str,
     state: str,
     state_store: InMemoryStateStore = STATE_STORE,
@@ -207,10 +243,10 @@ def handle_callback(
     if state_record is None:
         raise ValueError("Invalid or expired OAuth state.")
 
-    token_response = exchange_token(code=code)
+    token_response = await exchange_token(code=code)
     token_record = store_token(token_response, token_store=token_store)
 
-    smoke_test = smoke_test_search(token_record.access_token)
+    smoke_test = await smoke_test_search(token_record.access_token)
     return {
         "token": token_record,
         "smoke_test": smoke_test,
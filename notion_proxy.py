@@ -1,9 +1,10 @@
 from __future__ import annotations
 from typing import Any, Dict
 
+from fastapi.responses import ORJSONResponse
 from mcp.server.fastmcp import FastMCP
 from starlette.requests import Request
-from starlette.responses import JSONResponse, RedirectResponse
+from starlette.responses import RedirectResponse
 
 from auth import InMemoryPrincipalStore, JWTAuthMiddleware, SupabaseJwksClient
 
@@ -20,13 +21,13 @@ AUTH_URL = os.getenv("AUTH_URL", "https://auth.localhost:8443")
 
 """-- METADATA --"""
 @mcp.custom_route("/.well-known/oauth-protected-resource", methods=["GET"])
-async def get_oauth_protected_resource_metadata(_: Request) -> JSONResponse:
+async def get_oauth_protected_resource_metadata(_: Request) -> ORJSONResponse:
     metadata = {
         "resource": f"{AUTH_URL}",
         "authorization_servers": [f"{AUTH_URL}"],
         "scopes_supported": ["mcp:read", "mcp:write"]
     }
-    return JSONResponse(metadata)
+    return ORJSONResponse(metadata)
 
 
 # Creates an ASGI app that serves MCP over HTTP.
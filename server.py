@@ -1,35 +1,45 @@
 from fastapi import FastAPI
-from fastapi.middleware.trustedhost import TrustedHostMiddleware
-from starlette.applications import Starlette
-from starlette.routing import Host
+from fastapi.responses import ORJSONResponse
 from starlette.requests import Request
-from starlette.responses import JSONResponse, RedirectResponse
+from starlette.responses import PlainTextResponse, RedirectResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 from notion_proxy import mcp_asgi
-from auth import InMemoryPrincipalStore, JWTAuthMiddleware, SupabaseJwksClient
-from contextlib import asynccontextmanager
-from notion_oauth import handle_callback, start_oauth
+from auth import (
+    PRINCIPAL_REDIS_URLS,
+    InMemoryPrincipalStore,
+    JWTAuthMiddleware,
+    PrincipalStore,
+    RedisShardedPrincipalStore,
+    SupabaseJwksClient,
+    close_jwks_http,
+)
+from contextlib import asynccontextmanager, suppress
+from notion_oauth import TokenRecord, close_notion_http, handle_callback, start_oauth
 
+import asyncio
 import logging
 import os
+from datetime import datetime, timezone
 from typing import Any, Dict
-from dataclasses import asdict
 
 
-auth_app = FastAPI()
+auth_app = FastAPI(default_response_class=ORJSONResponse)
 logger = logging.getLogger("notion.oauth")
-principal_store = InMemoryPrincipalStore()
+principal_store: PrincipalStore = (
+    RedisShardedPrincipalStore(PRINCIPAL_REDIS_URLS) if PRINCIPAL_REDIS_URLS else InMemoryPrincipalStore()
+)
 jwks_client = SupabaseJwksClient()
 
 
-def _serialize_token(token: Any) -> Dict[str, Any]:
-    data = asdict(token)
-    created_at = data.get("created_at")
-    if created_at is not None:
-        data["created_at"] = created_at.isoformat()
-    data.pop("access_token", None)
-    data.pop("raw", None)
-    return data
+def _serialize_token(token: TokenRecord) -> Dict[str, Any]:
+    # Project the public fields by hand; asdict() would deep-copy `raw` only to drop it.
+    return {
+        "workspace_id": token.workspace_id,
+        "workspace_name": token.workspace_name,
+        "created_at": datetime.fromtimestamp(token.created_at, timezone.utc).isoformat(),
+        "scope": token.scope,
+    }
 
 
 @auth_app.get("/notion/oauth/start")
@@ -39,16 +49,16 @@ async def notion_oauth_start(_: Request) -> RedirectResponse:
 
 
 @auth_app.get("/notion/oauth/callback")
-async def notion_oauth_callback(request: Request) -> JSONResponse:
+async def notion_oauth_callback(request: Request) -> ORJSONResponse:
     code = request.query_params.get("code")
     state = request.query_params.get("state")
     if not code or not state:
-        return JSONResponse({"error": "Missing code or state"}, status_code=400)
+        return ORJSONResponse({"error": "Missing code or state"}, status_code=400)
 
     try:
-        result = handle_callback(code=code, state=state)
+        result = await handle_callback(code=code, state=state)
     except ValueError as exc:
-        return JSONResponse({"error": str(exc)}, status_code=400)
+        return ORJSONResponse({"error": str(exc)}, status_code=400)
 
     raw = result["token"].raw
     logger.info("Notion OAuth token exchange successful.")
@@ -56,7 +66,7 @@ async def notion_oauth_callback(request: Request) -> JSONResponse:
     logger.info("Notion refresh_token: %s", raw.get("refresh_token"))
 
     token_payload = _serialize_token(result["token"])
-    return JSONResponse(
+    return ORJSONResponse(
         {
             "token": token_payload,
             "smoke_test": result["smoke_test"],
@@ -65,9 +75,18 @@ async def notion_oauth_callback(request: Request) -> JSONResponse:
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    async with mcp_asgi.router.lifespan_context(app):
-        yield
-mcp_host_app = FastAPI(lifespan=lifespan)
+    refresher = asyncio.create_task(jwks_client.start_refresher())
+    try:
+        async with mcp_asgi.router.lifespan_context(app):
+            yield
+    finally:
+        refresher.cancel()
+        with suppress(asyncio.CancelledError):
+            await refresher
+        await close_notion_http()
+        await close_jwks_http()
+        await principal_store.aclose()
+mcp_host_app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 mcp_host_app.mount("/", mcp_asgi)
 
 @mcp_host_app.get("/health")
@@ -85,16 +104,38 @@ mcp_host_app.add_middleware(
 # -------------------------
 # Top-level host router
 # -------------------------
-app = Starlette(
-    routes=[
-        Host("auth.localhost", app=auth_app),
-        Host("mcp.localhost", app=mcp_host_app),
-    ]
-)
-#TODO, test if it is encessary
-app.add_middleware(
-    TrustedHostMiddleware,
-    allowed_hosts=["auth.localhost", "mcp.localhost"]
+class HostDispatcher:
+    """Dispatch to a sub-app by exact Host header (port stripped) with one dict lookup.
+
+    Unknown hosts get the same 400 that TrustedHostMiddleware used to send.
+    Lifespan events go to `lifespan_app`, since Starlette's Host routes never
+    forwarded them to the mounted apps.
+    """
+
+    def __init__(self, hosts: Dict[str, ASGIApp], lifespan_app: ASGIApp) -> None:
+        self._hosts = {host.encode(): host_app for host, host_app in hosts.items()}
+        self._lifespan_app = lifespan_app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan_app(scope, receive, send)
+            return
+
+        host = next((value for key, value in scope["headers"] if key == b"host"), b"")
+        host_app = self._hosts.get(host.partition(b":")[0])
+        if host_app is None:
+            response = PlainTextResponse("Invalid host header", status_code=400)
+            await response(scope, receive, send)
+            return
+        await host_app(scope, receive, send)
+
+
+app = HostDispatcher(
+    {
+        "auth.localhost": auth_app,
+        "mcp.localhost": mcp_host_app,
+    },
+    lifespan_app=mcp_host_app,
 )
 
 def get_app():